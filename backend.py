@@ -7,29 +7,307 @@ Simple WhatsApp Trigger Manager Backend
 - WhatsApp webhook handling
 """
 
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string
+from flask.json.provider import JSONProvider
 import sqlite3
-import json
-import uuid
+import atexit
+import gzip
 import hashlib
+import heapq
+import hmac
+import logging
+import logging.handlers
 import os
-from datetime import datetime
+import queue
+import secrets
+import sys
+import socket
+import threading
+import time
+from collections import deque
+from functools import lru_cache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+import orjson
 
 # Load environment variables
 load_dotenv()
 
+def orjson_default(obj):
+    """Serialize sqlite3.Row query results as JSON objects"""
+    if isinstance(obj, sqlite3.Row):
+        return dict(zip(obj.keys(), obj))
+    raise TypeError
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, a much faster C encoder/decoder"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=orjson_default).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of decoding to
+        # str and letting Werkzeug encode them back
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=orjson_default), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+logger = logging.getLogger(__name__)
+
+def configure_logging():
+    """Configure root logging from LOG_LEVEL (called by the entry points)"""
+    # Request threads only enqueue records; a single listener thread formats
+    # them and does the writes to stdout
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
+    atexit.register(listener.stop)
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        handlers=[logging.handlers.QueueHandler(log_queue)])
+
+# Meta app secret used to verify X-Hub-Signature-256 on incoming webhooks
+# (verification is skipped when it is not set). It is shared by every trigger,
+# so it only fits deployments whose triggers all belong to one Meta app.
+APP_SECRET = os.getenv('APP_SECRET', '')
+
+def verify_webhook_signature(raw, signature):
+    """Check Meta's HMAC-SHA256 signature of the raw webhook body"""
+    if not APP_SECRET:
+        return True
+    expected = hmac.new(APP_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+    # Compare bytes: compare_digest rejects str holding non-ASCII characters
+    return hmac.compare_digest(signature.removeprefix('sha256=').encode('latin-1'), expected.encode())
+
+# Number of Graph API sends that can be in flight at once from the background pool
+SEND_CONCURRENCY = int(os.getenv('SEND_CONCURRENCY', '16'))
+
+# Shared HTTP session so calls to the Graph API reuse pooled keep-alive
+# connections instead of paying a new TCP + TLS handshake per message.
+# Every Graph API call is a POST, so retries are limited to cases where Meta
+# never processed the message: connection failures, 429 throttling, and 503s
+# carrying Retry-After (whose delay is honoured). Read timeouts and other 5xx
+# are not retried, since the message may already have been delivered.
+# Idle pooled connections get silently dropped by NATs and load balancers,
+# forcing a new DNS lookup + TCP/TLS handshake; TCP keepalive holds them open
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets use TCP keepalive"""
+    def init_poolmanager(self, *args, **kwargs):
+        socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            socket_options += [
+                (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 20),
+                (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+            ]
+        kwargs['socket_options'] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+SESSION = requests.Session()
+SESSION.mount('https://', KeepAliveAdapter(
+    pool_connections=4,
+    pool_maxsize=SEND_CONCURRENCY * 2,  # headroom for synchronous /send requests
+    # Wait for a pooled connection instead of opening a throwaway one (and a
+    # fresh TLS handshake) whenever a burst outruns the pool
+    pool_block=True,
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.2,
+        status_forcelist=[429],
+        allowed_methods=frozenset(['POST']),
+        # Hand the final 429 back so callers can report Meta's error body
+        raise_on_status=False
+    )
+))
+# Snapshot proxy and CA-bundle settings from the environment once, then stop
+# requests from re-reading the environment and ~/.netrc on every send
+SESSION.proxies.update(requests.utils.get_environ_proxies('https://graph.facebook.com'))
+SESSION.verify = os.getenv('REQUESTS_CA_BUNDLE') or os.getenv('CURL_CA_BUNDLE') or True
+SESSION.trust_env = False
+# Every Graph API body is JSON; only the per-number Authorization header varies
+SESSION.headers['Content-Type'] = 'application/json'
+GRAPH_API_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+
+# Outbound sends are queued and drained by SEND_CONCURRENCY background workers,
+# so the Meta round-trip doesn't hold a Flask worker (or the webhook's SQLite
+# write transaction). Replies for a webhook batch overlap their round-trips,
+# and each WhatsApp number is paced to stay under Meta's throughput limits.
+# Pacing happens in a separate pacer thread that holds each number's backlog
+# and only hands sends to OUT_QUEUE once they are allowed, so a busy number
+# never parks the workers that other numbers' replies need.
+OUT_QUEUE = queue.SimpleQueue()
+SEND_QUEUE_LIMIT = 10000  # queued + in-flight sends before new ones are dropped
+SEND_RATE_PER_NUMBER = 10  # messages per second per phone_id
+
+# Inbound webhook messages are buffered and written by one background thread
+# in batches, so the reply to Meta doesn't wait on SQLite. Rows still buffered
+# if the process is killed are lost; a normal exit flushes them. The buffer is
+# bounded: if a stalled disk lets it fill, new rows are logged and dropped
+# rather than parking request threads.
+MESSAGE_BUFFER = queue.Queue(maxsize=10000)
+MESSAGE_FLUSH_INTERVAL = 0.2  # seconds the flusher waits for new rows
+MESSAGE_FLUSH_BATCH = 500
+
+# Webhook messages for triggers with a lead flow are saved, and their lead
+# updates applied, by a single background thread, which keeps each sender's
+# answers in order. Like the message buffer, events still queued when the
+# process stops are lost.
+LEAD_QUEUE = queue.Queue(maxsize=10000)
+
+# The frontend is static, so read and gzip it once at startup
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frontend.html'), 'rb') as f:
+    FRONTEND_HTML = f.read()
+FRONTEND_HTML_GZIP = gzip.compress(FRONTEND_HTML)
+FRONTEND_ETAG = hashlib.sha256(FRONTEND_HTML).hexdigest()[:16]
 
 # Database setup
 DATABASE = 'triggers.db'
 
+# INSERT ... RETURNING needs SQLite 3.35+
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Largest SQLite rowid (signed 64-bit)
+MAX_ROWID = 2**63 - 1
+
+# On SQLite 3.31+ messages.display_name is a STORED generated column (added by
+# init_db), computed once per insert; older versions build it on every read
+SQLITE_HAS_GENERATED_COLUMNS = sqlite3.sqlite_version_info >= (3, 31, 0)
+MESSAGE_DISPLAY_NAME = 'display_name' if SQLITE_HAS_GENERATED_COLUMNS else (
+    "CASE WHEN contact_name <> '' THEN contact_name || ' (' || sender_number || ')' ELSE sender_number END AS display_name"
+)
+
+# Hot-path SQL statements, defined once so every call reuses the same
+# text and hits sqlite3's per-connection prepared statement cache
+SQL_GET_TRIGGER = 'SELECT * FROM triggers WHERE id = ?'
+SQL_GET_TRIGGER_BY_NODE = 'SELECT * FROM triggers WHERE node_id = ?'
+SQL_GET_ALL_TRIGGERS = 'SELECT * FROM triggers'
+# Everything the trigger list shows, minus the Meta access token
+SQL_LIST_TRIGGERS = '''
+    SELECT id, node_id, business_name, app_id, phone_id, callback_url, verify_token, status, completion_message, created_at
+    FROM triggers
+    ORDER BY created_at DESC
+'''
+SQL_INSERT_TRIGGER = '''
+    INSERT INTO triggers (node_id, business_name, app_id, phone_id, access_token, callback_url, verify_token)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+SQL_TOGGLE_TRIGGER = "UPDATE triggers SET status = CASE status WHEN 'inactive' THEN 'active' ELSE 'inactive' END WHERE id = ?"
+SQL_DELETE_TRIGGER = 'DELETE FROM triggers WHERE id = ?'
+SQL_GET_LEAD_BY_PHONE = 'SELECT * FROM leads WHERE trigger_id = ? AND phone_number = ?'
+
+# Narrow reads: only the columns each caller actually uses.
+# Keep these lists in sync with the fields read from the rows.
+SQL_GET_TRIGGER_SENDER = '''
+    SELECT id, business_name, phone_id, access_token, status, completion_message
+    FROM triggers WHERE id = ?
+'''
+SQL_GET_LEAD_STATE = '''
+    SELECT id, current_question, current_question_id, responses
+    FROM leads WHERE trigger_id = ? AND phone_number = ?
+'''
+# Builds the whole leads array in SQLite, embedding the stored responses
+# JSON as-is instead of decoding and re-encoding it row by row in Python
+SQL_GET_LEADS_JSON = '''
+    SELECT json_group_array(json_object(
+        'id', id,
+        'phone_number', phone_number,
+        'contact_name', contact_name,
+        'status', status,
+        'current_question', current_question,
+        'responses', CASE WHEN json_valid(responses) THEN json(responses) ELSE json('{}') END,
+        'created_at', created_at,
+        'updated_at', updated_at
+    ))
+    FROM (
+        SELECT id, phone_number, contact_name, status, current_question, responses, created_at, updated_at
+        FROM leads
+        WHERE trigger_id = ?
+        ORDER BY created_at DESC
+    )
+'''
+SQL_GET_TRIGGER_MESSAGES = f'''
+    SELECT
+        id, trigger_id, sender_number, message_content, message_type, contact_name, received_at,
+        CASE WHEN contact_name <> '' THEN contact_name END AS contact_name_only,
+        {MESSAGE_DISPLAY_NAME}
+    FROM messages
+    WHERE trigger_id = ?
+    ORDER BY received_at DESC
+'''
+SQL_GET_RECENT_MESSAGES = f'''
+    SELECT
+        m.id, m.trigger_id, m.sender_number, m.message_content, m.message_type, m.contact_name, m.received_at,
+        CASE WHEN m.contact_name <> '' THEN m.contact_name END AS contact_name_only,
+        {MESSAGE_DISPLAY_NAME},
+        t.business_name,
+        t.node_id
+    FROM messages m
+    JOIN triggers t ON m.trigger_id = t.id
+    WHERE m.id < ?
+    ORDER BY m.id DESC
+    LIMIT 100
+'''
+SQL_INSERT_LEAD_QUESTION = '''
+    INSERT INTO lead_questions (trigger_id, question_text, question_type, options, is_required, order_index)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+SQL_GET_LEAD_QUESTIONS = 'SELECT * FROM lead_questions WHERE trigger_id = ? ORDER BY order_index ASC, id ASC'
+SQL_INSERT_LEAD = '''
+    INSERT INTO leads (trigger_id, phone_number, contact_name, status, current_question, current_question_id, responses)
+    VALUES (?, ?, ?, 'active', 0, ?, '{}')
+'''
+SQL_UPDATE_LEAD_PROGRESS = '''
+    UPDATE leads
+    SET responses = ?, current_question = ?, current_question_id = ?, status = ?, updated_at = CURRENT_TIMESTAMP
+    WHERE id = ?
+'''
+
+# Meta redelivers webhooks it thinks timed out; the unique meta_message_id
+# index turns those repeats into no-ops instead of duplicate rows
+SQL_INSERT_MESSAGE = '''
+    INSERT OR IGNORE INTO messages (trigger_id, sender_number, message_content, message_type, contact_name, meta_message_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+SQL_UPDATE_MESSAGE_STATUS = 'UPDATE messages SET message_type = ?, meta_message_id = ? WHERE id = ?'
+
 def init_db():
     """Initialize the database"""
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
     
+    # WAL mode is persistent, so it only needs to be set once per database
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
+    # A new database gets the current schema straight from the CREATE statements
+    # below, so only files from earlier releases need the migrations
+    fresh = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'triggers'").fetchone() is None
+    
+    # display_name is filled in by SQLite on insert where generated columns exist
+    display_name_column = '''
+                display_name TEXT GENERATED ALWAYS AS (
+                    CASE WHEN contact_name <> '' THEN contact_name || ' (' || sender_number || ')' ELSE sender_number END
+                ) STORED,''' if SQLITE_HAS_GENERATED_COLUMNS else ''
+    create_messages_sql = f'''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                trigger_id INTEGER,
+                sender_number TEXT NOT NULL,
+                message_content TEXT NOT NULL,
+                message_type TEXT DEFAULT 'text',
+                contact_name TEXT DEFAULT '',
+                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                meta_message_id TEXT,{display_name_column}
+                FOREIGN KEY (trigger_id) REFERENCES triggers (id) ON DELETE CASCADE
+            )
+    '''
+    
     # Create triggers table
     cursor.execute('''
             CREATE TABLE IF NOT EXISTS triggers (
@@ -48,18 +326,7 @@ def init_db():
         ''')
     
     # Create messages table
-    cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                trigger_id INTEGER,
-                sender_number TEXT NOT NULL,
-                message_content TEXT NOT NULL,
-                message_type TEXT DEFAULT 'text',
-                contact_name TEXT DEFAULT '',
-                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (trigger_id) REFERENCES triggers (id)
-            )
-    ''')
+    cursor.execute(create_messages_sql)
     
     # Create leads table
     cursor.execute('''
@@ -70,10 +337,11 @@ def init_db():
                 contact_name TEXT DEFAULT '',
                 status TEXT DEFAULT 'active',
                 current_question INTEGER DEFAULT 0,
+                current_question_id INTEGER,
                 responses TEXT DEFAULT '{}',
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (trigger_id) REFERENCES triggers (id)
+                FOREIGN KEY (trigger_id) REFERENCES triggers (id) ON DELETE CASCADE
             )
     ''')
     
@@ -88,51 +356,314 @@ def init_db():
                 is_required BOOLEAN DEFAULT 1,
                 order_index INTEGER DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (trigger_id) REFERENCES triggers (id)
+                FOREIGN KEY (trigger_id) REFERENCES triggers (id) ON DELETE CASCADE
             )
     ''')
     
-    # Add contact_name column if it doesn't exist (for existing databases)
-    try:
-        cursor.execute('ALTER TABLE messages ADD COLUMN contact_name TEXT DEFAULT ""')
-        print("✅ Added contact_name column to messages table")
-    except sqlite3.OperationalError:
-        # Column already exists
-        pass
+    # Migrations run once per database; PRAGMA user_version records the last one applied
+    if fresh:
+        cursor.execute(f'PRAGMA user_version = {2 if SQLITE_HAS_GENERATED_COLUMNS else 1}')
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
     
-    # Add completion_message column if it doesn't exist (for existing databases)
-    try:
-        cursor.execute('ALTER TABLE triggers ADD COLUMN completion_message TEXT DEFAULT ""')
-        print("✅ Added completion_message column to triggers table")
-    except sqlite3.OperationalError:
-        # Column already exists
-        pass
+    if version < 1:
+        # Bring databases created by earlier releases up to the current schema
+        cursor.execute('BEGIN')
+        
+        message_columns = {column[1] for column in cursor.execute('PRAGMA table_info(messages)')}
+        if 'contact_name' not in message_columns:
+            cursor.execute('ALTER TABLE messages ADD COLUMN contact_name TEXT DEFAULT ""')
+            logger.info("✅ Added contact_name column to messages table")
+        
+        trigger_columns = {column[1] for column in cursor.execute('PRAGMA table_info(triggers)')}
+        if 'completion_message' not in trigger_columns:
+            cursor.execute('ALTER TABLE triggers ADD COLUMN completion_message TEXT DEFAULT ""')
+            logger.info("✅ Added completion_message column to triggers table")
+        
+        lead_columns = {column[1] for column in cursor.execute('PRAGMA table_info(leads)')}
+        if 'current_question_id' not in lead_columns:
+            cursor.execute('ALTER TABLE leads ADD COLUMN current_question_id INTEGER')
+            
+            # Point active leads at the question matching their current_question position
+            cursor.execute('''
+                UPDATE leads SET current_question_id = (
+                    SELECT q.id FROM lead_questions q
+                    WHERE q.trigger_id = leads.trigger_id AND (
+                        SELECT COUNT(*) FROM lead_questions p
+                        WHERE p.trigger_id = q.trigger_id
+                        AND (p.order_index < q.order_index OR (p.order_index = q.order_index AND p.id < q.id))
+                    ) = leads.current_question
+                )
+                WHERE status = 'active'
+            ''')
+            logger.info("✅ Added current_question_id column to leads table")
+        
+        # Rebuild child tables created before their foreign keys cascaded on delete.
+        # SQLite can't alter a constraint in place, so copy into a fresh table.
+        for table in ('messages', 'leads', 'lead_questions'):
+            foreign_keys = cursor.execute(f'PRAGMA foreign_key_list({table})').fetchall()
+            if all(fk[6] == 'CASCADE' for fk in foreign_keys):
+                continue
+            
+            create_sql = cursor.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+            ).fetchone()[0]
+            create_sql = create_sql.replace('REFERENCES triggers (id)', 'REFERENCES triggers (id) ON DELETE CASCADE')
+            
+            cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+            cursor.execute(create_sql)
+            cursor.execute(f'INSERT INTO {table} SELECT * FROM {table}_old')
+            cursor.execute(f'DROP TABLE {table}_old')
+            logger.info("✅ Added ON DELETE CASCADE to %s table", table)
+        
+        cursor.execute('PRAGMA user_version = 1')
+        conn.commit()
+    
+    if version < 2 and SQLITE_HAS_GENERATED_COLUMNS:
+        # Store display_name on each message row. ALTER TABLE can only add
+        # VIRTUAL generated columns, so rebuild the table with a STORED one.
+        cursor.execute('BEGIN')
+        cursor.execute('ALTER TABLE messages RENAME TO messages_old')
+        cursor.execute(create_messages_sql)
+        columns = ', '.join(column[1] for column in cursor.execute('PRAGMA table_info(messages_old)'))
+        cursor.execute(f'INSERT INTO messages ({columns}) SELECT {columns} FROM messages_old')
+        cursor.execute('DROP TABLE messages_old')
+        cursor.execute('PRAGMA user_version = 2')
+        conn.commit()
+        logger.info("✅ Added display_name column to messages table")
+    
+    # Checked by presence rather than user_version, so databases that can't
+    # take the generated-column rebuild above still get it
+    message_columns = {column[1] for column in cursor.execute('PRAGMA table_info(messages)')}
+    if 'meta_message_id' not in message_columns:
+        cursor.execute('ALTER TABLE messages ADD COLUMN meta_message_id TEXT')
+        logger.info("✅ Added meta_message_id column to messages table")
+    
+    # Index the foreign keys, covering each lookup's ORDER BY so no sort is needed.
+    # triggers.node_id is already indexed by its UNIQUE constraint.
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_trigger_received ON messages (trigger_id, received_at DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_leads_trigger_created ON leads (trigger_id, created_at DESC)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_leads_trigger_phone ON leads (trigger_id, phone_number)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_questions_trigger_order ON lead_questions (trigger_id, order_index)')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_messages_meta_id ON messages (meta_message_id) WHERE meta_message_id IS NOT NULL')
     
     conn.commit()
     conn.close()
+    
+    warm_trigger_cache()
+    
+    # Registered here, after configure_logging() started the log listener, so
+    # the final flush runs (atexit is last-in, first-out) while it still writes
+    atexit.unregister(flush_message_buffer)
+    atexit.register(flush_message_buffer)
 
-def get_db_connection():
-    """Get database connection"""
-    conn = sqlite3.connect(DATABASE)
+# Connections are opened once per thread and reused across requests
+_local = threading.local()
+
+def _open_db_connection(readonly=False):
+    """Open a new database connection with the per-connection PRAGMAs applied"""
+    # Autocommit mode; multi-statement writes issue an explicit BEGIN IMMEDIATE
+    if readonly:
+        conn = sqlite3.connect(f'file:{DATABASE}?mode=ro', uri=True,
+                               check_same_thread=False, isolation_level=None)
+    else:
+        conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    
+    # Per-connection settings (journal_mode=WAL is persisted by init_db)
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA busy_timeout=5000')  # wait out a concurrent writer instead of failing
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-20000')
+    if sys.maxsize > 2**32:
+        # Read pages straight from the OS page cache; a 256 MB mapping only
+        # fits comfortably in a 64-bit address space
+        conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA foreign_keys=ON')
+    
+    if readonly:
+        conn.execute('PRAGMA query_only=ON')
+    else:
+        # Writers checkpoint the WAL every ~1000 pages; the size limit truncates
+        # it afterwards so a write burst doesn't leave a large -wal file behind
+        conn.execute('PRAGMA wal_autocheckpoint=1000')
+        conn.execute('PRAGMA journal_size_limit=67108864')
     return conn
 
+def get_db_connection(readonly=False):
+    """Get the database connection cached for the current thread"""
+    attr = 'ro_conn' if readonly else 'conn'
+    conn = getattr(_local, attr, None)
+    if conn is None:
+        conn = _open_db_connection(readonly)
+        setattr(_local, attr, conn)
+    return conn
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    """Keep the thread's connection open but never leak an open transaction"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# In-process cache of each trigger's lead questions in ask order, so inbound
+# messages don't re-query lead_questions. Entries are dropped whenever a
+# trigger's questions change; the generation counter stops a reader that
+# raced an invalidation from caching the stale list it loaded.
+_question_cache = {}
+_question_cache_lock = threading.Lock()
+_question_cache_generation = 0
+
+def get_trigger_questions(conn, trigger_id):
+    """Get a trigger's lead questions ordered by (order_index, id)"""
+    with _question_cache_lock:
+        questions = _question_cache.get(trigger_id)
+        generation = _question_cache_generation
+    
+    if questions is None:
+        questions = [dict(q) for q in conn.execute(SQL_GET_LEAD_QUESTIONS, (trigger_id,))]
+        with _question_cache_lock:
+            if generation == _question_cache_generation:
+                _question_cache[trigger_id] = questions
+    return questions
+
+def invalidate_trigger_questions(trigger_id):
+    """Drop a trigger's cached questions after they change"""
+    global _question_cache_generation
+    with _question_cache_lock:
+        _question_cache.pop(trigger_id, None)
+        _question_cache_generation += 1
+
+def find_question(questions, question_id):
+    """Return (current, next) for a lead's current question id"""
+    for position, question in enumerate(questions):
+        if question['id'] == question_id:
+            next_question = questions[position + 1] if position + 1 < len(questions) else None
+            return question, next_question
+    return None, None
+
+# Trigger rows by node_id for the webhook endpoints, which Meta can call many
+# times a second. Entries expire after TRIGGER_CACHE_TTL seconds, and the whole
+# cache is dropped (and its generation bumped) whenever a trigger changes.
+TRIGGER_CACHE_TTL = 60
+_trigger_cache = {}
+_trigger_cache_lock = threading.Lock()
+_trigger_cache_generation = 0
+
+def get_trigger_by_node(node_id):
+    """Get a trigger row by node_id, cached in-process for TRIGGER_CACHE_TTL seconds
+
+    Only a cache miss touches SQLite, through the thread's read-only connection.
+    """
+    now = time.monotonic()
+    with _trigger_cache_lock:
+        cached = _trigger_cache.get(node_id)
+        generation = _trigger_cache_generation
+    
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    trigger = get_db_connection(readonly=True).execute(SQL_GET_TRIGGER_BY_NODE, (node_id,)).fetchone()
+    if trigger:
+        with _trigger_cache_lock:
+            if generation == _trigger_cache_generation:
+                _trigger_cache[node_id] = (now + TRIGGER_CACHE_TTL, trigger)
+    return trigger
+
+def warm_trigger_cache():
+    """Load every trigger into the node_id cache so the first webhooks skip SQLite"""
+    triggers = get_db_connection(readonly=True).execute(SQL_GET_ALL_TRIGGERS).fetchall()
+    expires = time.monotonic() + TRIGGER_CACHE_TTL
+    with _trigger_cache_lock:
+        _trigger_cache.update((trigger['node_id'], (expires, trigger)) for trigger in triggers)
+
+def invalidate_trigger_cache():
+    """Drop all cached trigger rows after a trigger changes"""
+    global _trigger_cache_generation
+    with _trigger_cache_lock:
+        _trigger_cache.clear()
+        _trigger_cache_generation += 1
+
+def drain_message_buffer(timeout):
+    """Take up to MESSAGE_FLUSH_BATCH buffered rows, waiting up to timeout for the first"""
+    try:
+        batch = [MESSAGE_BUFFER.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    
+    while len(batch) < MESSAGE_FLUSH_BATCH:
+        try:
+            batch.append(MESSAGE_BUFFER.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+def write_messages(conn, batch):
+    """Insert a batch of message rows in one transaction"""
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(SQL_INSERT_MESSAGE, batch)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        # A trigger was deleted while its messages were buffered; keep the rest.
+        # A failed INSERT only undoes that statement, so the retry still
+        # shares a single transaction and commit
+        conn.rollback()
+        conn.execute('BEGIN IMMEDIATE')
+        for row in batch:
+            try:
+                conn.execute(SQL_INSERT_MESSAGE, row)
+            except sqlite3.IntegrityError:
+                logger.warning("⚠️ Dropping message for deleted trigger %s", row[0])
+        conn.commit()
+
+def message_flush_loop():
+    """Background thread: write buffered webhook messages to SQLite"""
+    while True:
+        batch = drain_message_buffer(MESSAGE_FLUSH_INTERVAL)
+        if not batch:
+            continue
+        
+        conn = get_db_connection()
+        try:
+            write_messages(conn, batch)
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            logger.exception("❌ Failed to write %d buffered messages", len(batch))
+
+def flush_message_buffer():
+    """Write whatever is still buffered (runs at interpreter exit)"""
+    batch = drain_message_buffer(0)
+    while batch:
+        write_messages(get_db_connection(), batch)
+        batch = drain_message_buffer(0)
+
+threading.Thread(target=message_flush_loop, name='message-flush', daemon=True).start()
+
 @app.route('/')
 def index():
     """Serve the frontend"""
-    with open('frontend.html', 'r') as f:
-        return f.read()
+    if request.accept_encodings['gzip'] > 0:
+        response = Response(FRONTEND_HTML_GZIP, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(FRONTEND_ETAG + '-gz')
+    else:
+        response = Response(FRONTEND_HTML, mimetype='text/html')
+        response.set_etag(FRONTEND_ETAG)
+    response.headers['Vary'] = 'Accept-Encoding'
+    # Browsers revalidate on each load and get a bodyless 304 until the file changes
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/triggers', methods=['GET'])
 def get_triggers():
     """Get all triggers"""
-    conn = get_db_connection()
-    triggers = conn.execute('SELECT * FROM triggers ORDER BY created_at DESC').fetchall()
-    conn.close()
+    conn = get_db_connection(readonly=True)
+    triggers = conn.execute(SQL_LIST_TRIGGERS).fetchall()
     
     return jsonify({
         'success': True,
-        'data': [dict(trigger) for trigger in triggers]
+        'data': triggers
     })
 
 @app.route('/api/triggers', methods=['POST'])
@@ -141,10 +672,10 @@ def create_trigger():
     data = request.get_json()
     
     # Generate unique node_id
-    node_id = str(uuid.uuid4())[:8]
+    node_id = secrets.token_hex(4)
     
-    # Generate verify token
-    verify_token = hashlib.md5(f"{node_id}{datetime.now()}".encode()).hexdigest()[:16]
+    # Generate verify token (96 random bits in the same 16 characters)
+    verify_token = secrets.token_urlsafe(12)
     
     # Generate callback URL using environment variable
     base_url = os.getenv('BASE_CALLBACK_URL', request.host_url.rstrip('/'))
@@ -153,10 +684,7 @@ def create_trigger():
     
     conn = get_db_connection()
     try:
-        cursor = conn.execute('''
-            INSERT INTO triggers (node_id, business_name, app_id, phone_id, access_token, callback_url, verify_token)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
+        params = (
             node_id,
             data['business_name'],
             data['app_id'],
@@ -164,21 +692,24 @@ def create_trigger():
             data['access_token'],
             callback_url,
             verify_token
-        ))
-        trigger_id = cursor.lastrowid
-        conn.commit()
+        )
         
-        # Get the created trigger
-        trigger = conn.execute('SELECT * FROM triggers WHERE id = ?', (trigger_id,)).fetchone()
-        conn.close()
+        if SQLITE_HAS_RETURNING:
+            # Insert and read back the created trigger in one statement; fetchall
+            # runs the statement to completion so the write is committed
+            trigger = conn.execute(SQL_INSERT_TRIGGER + ' RETURNING *', params).fetchall()[0]
+        else:
+            cursor = conn.execute(SQL_INSERT_TRIGGER, params)
+            
+            # Get the created trigger
+            trigger = conn.execute(SQL_GET_TRIGGER, (cursor.lastrowid,)).fetchone()
         
         return jsonify({
             'success': True,
-            'data': dict(trigger),
+            'data': trigger,
             'message': 'Trigger created successfully!'
         })
     except Exception as e:
-        conn.close()
         return jsonify({
             'success': False,
             'error': str(e)
@@ -188,17 +719,21 @@ def create_trigger():
 def toggle_trigger(trigger_id):
     """Toggle trigger status"""
     conn = get_db_connection()
-    trigger = conn.execute('SELECT * FROM triggers WHERE id = ?', (trigger_id,)).fetchone()
     
-    if not trigger:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Trigger not found'}), 404
+    # Flip the status in SQL so concurrent toggles can't race on a stale read
+    if SQLITE_HAS_RETURNING:
+        rows = conn.execute(SQL_TOGGLE_TRIGGER + ' RETURNING status', (trigger_id,)).fetchall()
+    else:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(SQL_TOGGLE_TRIGGER, (trigger_id,))
+        rows = conn.execute('SELECT status FROM triggers WHERE id = ?', (trigger_id,)).fetchall()
+        conn.commit()
     
-    new_status = 'active' if trigger['status'] == 'inactive' else 'inactive'
+    if not rows:
+        return jsonify({'success': False, 'error': 'Trigger not found'}), 404
     
-    conn.execute('UPDATE triggers SET status = ? WHERE id = ?', (new_status, trigger_id))
-    conn.commit()
-    conn.close()
+    new_status = rows[0]['status']
+    invalidate_trigger_cache()
     
     return jsonify({
         'success': True,
@@ -210,29 +745,31 @@ def toggle_trigger(trigger_id):
 def delete_trigger(trigger_id):
     """Delete a trigger and all its messages"""
     conn = get_db_connection()
-    trigger = conn.execute('SELECT * FROM triggers WHERE id = ?', (trigger_id,)).fetchone()
-    
-    if not trigger:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Trigger not found'}), 404
     
     try:
-        # Delete all messages for this trigger first
-        conn.execute('DELETE FROM messages WHERE trigger_id = ?', (trigger_id,))
+        # Messages, leads and lead questions are removed by ON DELETE CASCADE
+        if SQLITE_HAS_RETURNING:
+            rows = conn.execute(SQL_DELETE_TRIGGER + ' RETURNING business_name', (trigger_id,)).fetchall()
+        else:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute('SELECT business_name FROM triggers WHERE id = ?', (trigger_id,)).fetchall()
+            conn.execute(SQL_DELETE_TRIGGER, (trigger_id,))
+            conn.commit()
         
-        # Delete the trigger
-        conn.execute('DELETE FROM triggers WHERE id = ?', (trigger_id,))
+        if not rows:
+            return jsonify({'success': False, 'error': 'Trigger not found'}), 404
         
-        conn.commit()
-        conn.close()
+        invalidate_trigger_questions(trigger_id)
+        invalidate_trigger_cache()
         
         return jsonify({
             'success': True,
-            'message': f'Trigger "{trigger["business_name"]}" deleted successfully'
+            'message': f'Trigger "{rows[0]["business_name"]}" deleted successfully'
         })
         
     except Exception as e:
-        conn.close()
+        if conn.in_transaction:
+            conn.rollback()
         return jsonify({
             'success': False,
             'error': f'Failed to delete trigger: {str(e)}'
@@ -241,37 +778,21 @@ def delete_trigger(trigger_id):
 @app.route('/api/dashboard/messages', methods=['GET'])
 def get_all_messages():
     """Get all messages from all triggers for dashboard"""
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     
-    # Get all messages with trigger information
-    messages = conn.execute('''
-        SELECT 
-            m.*,
-            t.business_name,
-            t.node_id
-        FROM messages m
-        JOIN triggers t ON m.trigger_id = t.id
-        ORDER BY m.received_at DESC
-        LIMIT 100
-    ''').fetchall()
-    conn.close()
+    # Keyset pagination: pass ?before_id=<next_before_id> to fetch the next page.
+    # The query always bounds with a plain `id < ?` (no "IS NULL OR"), so SQLite
+    # can seek the rowid range; the first page uses the largest rowid, and any
+    # client value is clamped to the rowid range, since larger ints can't be bound.
+    before_id = min(max(request.args.get('before_id', MAX_ROWID, type=int), 0), MAX_ROWID)
     
-    # Convert to list of dictionaries and format contact names
-    formatted_messages = []
-    for message in messages:
-        msg_dict = dict(message)
-        # Provide both contact name and display name
-        if msg_dict.get('contact_name'):
-            msg_dict['contact_name_only'] = msg_dict['contact_name']
-            msg_dict['display_name'] = f"{msg_dict['contact_name']} ({msg_dict['sender_number']})"
-        else:
-            msg_dict['contact_name_only'] = None
-            msg_dict['display_name'] = msg_dict['sender_number']
-        formatted_messages.append(msg_dict)
+    # Get the newest messages with trigger information, walking the primary key
+    messages = conn.execute(SQL_GET_RECENT_MESSAGES, (before_id,)).fetchall()
     
     return jsonify({
         'success': True,
-        'data': formatted_messages
+        'data': messages,
+        'next_before_id': messages[-1]['id'] if len(messages) == 100 else None
     })
 
 # Lead Management API Endpoints
@@ -279,19 +800,25 @@ def get_all_messages():
 @app.route('/api/triggers/<int:trigger_id>/questions', methods=['GET'])
 def get_lead_questions(trigger_id):
     """Get lead questions for a trigger"""
-    conn = get_db_connection()
-    questions = conn.execute('''
-        SELECT * FROM lead_questions 
-        WHERE trigger_id = ? 
-        ORDER BY order_index ASC
-    ''', (trigger_id,)).fetchall()
-    conn.close()
+    conn = get_db_connection(readonly=True)
+    questions = conn.execute(SQL_GET_LEAD_QUESTIONS, (trigger_id,)).fetchall()
     
     return jsonify({
         'success': True,
-        'data': [dict(q) for q in questions]
+        'data': questions
     })
 
+def lead_question_params(trigger_id, question, order_index=0):
+    """Build the SQL_INSERT_LEAD_QUESTION parameters for one question payload"""
+    return (
+        trigger_id,
+        question['question_text'],
+        question.get('question_type', 'text'),
+        orjson.dumps(question.get('options', [])).decode(),
+        question.get('is_required', True),
+        question.get('order_index', order_index)
+    )
+
 @app.route('/api/triggers/<int:trigger_id>/questions', methods=['POST'])
 def create_lead_question(trigger_id):
     """Create a new lead question for a trigger"""
@@ -300,62 +827,71 @@ def create_lead_question(trigger_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        INSERT INTO lead_questions (trigger_id, question_text, question_type, options, is_required, order_index)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (
-        trigger_id,
-        data['question_text'],
-        data.get('question_type', 'text'),
-        json.dumps(data.get('options', [])),
-        data.get('is_required', True),
-        data.get('order_index', 0)
-    ))
+    try:
+        cursor.execute(SQL_INSERT_LEAD_QUESTION, lead_question_params(trigger_id, data))
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Failed to create question: {str(e)}'
+        }), 400
     
-    conn.commit()
     question_id = cursor.lastrowid
-    conn.close()
+    invalidate_trigger_questions(trigger_id)
     
     return jsonify({
         'success': True,
         'data': {'id': question_id}
     })
 
-@app.route('/api/triggers/<int:trigger_id>/leads', methods=['GET'])
-def get_leads(trigger_id):
-    """Get all leads for a trigger"""
+@app.route('/api/triggers/<int:trigger_id>/questions/bulk', methods=['POST'])
+def create_lead_questions_bulk(trigger_id):
+    """Create several lead questions for a trigger in one transaction"""
+    data = request.get_json()
+    questions = data.get('questions', [])
+    
+    if not questions:
+        return jsonify({'success': False, 'error': 'No questions provided'}), 400
+    
     conn = get_db_connection()
-    leads = conn.execute('''
-        SELECT * FROM leads 
-        WHERE trigger_id = ? 
-        ORDER BY created_at DESC
-    ''', (trigger_id,)).fetchall()
-    conn.close()
+    try:
+        # Questions without an order_index keep their position in the list
+        params = [
+            lead_question_params(trigger_id, question, order_index)
+            for order_index, question in enumerate(questions)
+        ]
+        
+        conn.execute('BEGIN IMMEDIATE')
+        conn.executemany(SQL_INSERT_LEAD_QUESTION, params)
+        conn.commit()
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        return jsonify({
+            'success': False,
+            'error': f'Failed to create questions: {str(e)}'
+        }), 400
     
-    # Parse responses JSON
-    formatted_leads = []
-    for lead in leads:
-        lead_dict = dict(lead)
-        try:
-            lead_dict['responses'] = json.loads(lead_dict['responses'])
-        except:
-            lead_dict['responses'] = {}
-        formatted_leads.append(lead_dict)
+    invalidate_trigger_questions(trigger_id)
     
     return jsonify({
         'success': True,
-        'data': formatted_leads
+        'data': {'created': len(params)}
     })
 
+@app.route('/api/triggers/<int:trigger_id>/leads', methods=['GET'])
+def get_leads(trigger_id):
+    """Get all leads for a trigger"""
+    conn = get_db_connection(readonly=True)
+    leads_json = conn.execute(SQL_GET_LEADS_JSON, (trigger_id,)).fetchone()[0]
+    
+    # leads_json is already a serialized array, so splice it into the envelope
+    return Response('{"success": true, "data": ' + leads_json + '}', mimetype='application/json')
+
 @app.route('/api/triggers/<int:trigger_id>/leads/<phone_number>', methods=['GET'])
 def get_lead_by_phone(trigger_id, phone_number):
     """Get a specific lead by phone number"""
-    conn = get_db_connection()
-    lead = conn.execute('''
-        SELECT * FROM leads 
-        WHERE trigger_id = ? AND phone_number = ?
-    ''', (trigger_id, phone_number)).fetchone()
-    conn.close()
+    conn = get_db_connection(readonly=True)
+    lead = conn.execute(SQL_GET_LEAD_BY_PHONE, (trigger_id, phone_number)).fetchone()
     
     if not lead:
         return jsonify({
@@ -365,7 +901,7 @@ def get_lead_by_phone(trigger_id, phone_number):
     
     lead_dict = dict(lead)
     try:
-        lead_dict['responses'] = json.loads(lead_dict['responses'])
+        lead_dict['responses'] = orjson.loads(lead_dict['responses'])
     except:
         lead_dict['responses'] = {}
     
@@ -381,28 +917,19 @@ def delete_lead(trigger_id, lead_id):
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Check if lead exists and belongs to this trigger
-        lead = cursor.execute('''
-            SELECT * FROM leads 
+        # Delete the lead in one statement; no matching row means it doesn't
+        # exist or belongs to another trigger
+        cursor.execute('''
+            DELETE FROM leads 
             WHERE id = ? AND trigger_id = ?
-        ''', (lead_id, trigger_id)).fetchone()
+        ''', (lead_id, trigger_id))
         
-        if not lead:
-            conn.close()
+        if cursor.rowcount == 0:
             return jsonify({
                 'success': False,
                 'message': 'Lead not found'
             }), 404
         
-        # Delete the lead
-        cursor.execute('''
-            DELETE FROM leads 
-            WHERE id = ? AND trigger_id = ?
-        ''', (lead_id, trigger_id))
-        
-        conn.commit()
-        conn.close()
-        
         return jsonify({
             'success': True,
             'message': 'Lead deleted successfully'
@@ -428,8 +955,6 @@ def delete_all_leads(trigger_id):
         ''', (trigger_id,))
         
         deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -460,14 +985,12 @@ def update_completion_message(trigger_id):
         ''', (completion_message, trigger_id))
         
         if cursor.rowcount == 0:
-            conn.close()
             return jsonify({
                 'success': False,
                 'message': 'Trigger not found'
             }), 404
         
-        conn.commit()
-        conn.close()
+        invalidate_trigger_cache()
         
         return jsonify({
             'success': True,
@@ -485,42 +1008,33 @@ def create_or_update_lead(trigger_id, phone_number, contact_name='', response=''
     """Create or update a lead with a response"""
     conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
     
     # Check if lead exists
-    existing_lead = cursor.execute('''
-        SELECT * FROM leads 
-        WHERE trigger_id = ? AND phone_number = ?
-    ''', (trigger_id, phone_number)).fetchone()
+    existing_lead = cursor.execute(SQL_GET_LEAD_STATE, (trigger_id, phone_number)).fetchone()
     
     if existing_lead:
         # Update existing lead
         lead_dict = dict(existing_lead)
-        responses = json.loads(lead_dict['responses'])
+        responses = orjson.loads(lead_dict['responses'])
         
-        # Get current question
-        questions = cursor.execute('''
-            SELECT * FROM lead_questions 
-            WHERE trigger_id = ? 
-            ORDER BY order_index ASC
-        ''', (trigger_id,)).fetchall()
+        # Get current and next question
+        current_q, next_q = find_question(get_trigger_questions(conn, trigger_id), lead_dict['current_question_id'])
         
-        if questions and lead_dict['current_question'] < len(questions):
-            current_q = questions[lead_dict['current_question']]
+        if current_q:
             responses[f"q{current_q['id']}"] = response
             
             # Move to next question
-            next_question = lead_dict['current_question'] + 1
-            if next_question >= len(questions):
+            if next_q is None:
                 # All questions answered
                 status = 'completed'
             else:
                 status = 'active'
             
-            cursor.execute('''
-                UPDATE leads 
-                SET responses = ?, current_question = ?, status = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (json.dumps(responses), next_question, status, lead_dict['id']))
+            cursor.execute(SQL_UPDATE_LEAD_PROGRESS, (
+                orjson.dumps(responses).decode(), lead_dict['current_question'] + 1,
+                next_q['id'] if next_q else None, status, lead_dict['id']
+            ))
         else:
             # No questions or all answered
             cursor.execute('''
@@ -530,13 +1044,11 @@ def create_or_update_lead(trigger_id, phone_number, contact_name='', response=''
             ''', (lead_dict['id'],))
     else:
         # Create new lead
-        cursor.execute('''
-            INSERT INTO leads (trigger_id, phone_number, contact_name, status, current_question, responses)
-            VALUES (?, ?, ?, 'active', 0, '{}')
-        ''', (trigger_id, phone_number, contact_name))
+        questions = get_trigger_questions(conn, trigger_id)
+        first_q = questions[0] if questions else None
+        cursor.execute(SQL_INSERT_LEAD, (trigger_id, phone_number, contact_name, first_q['id'] if first_q else None))
     
     conn.commit()
-    conn.close()
     
     return jsonify({
         'success': True,
@@ -546,44 +1058,24 @@ def create_or_update_lead(trigger_id, phone_number, contact_name='', response=''
 @app.route('/api/triggers/<int:trigger_id>/messages', methods=['GET'])
 def get_trigger_messages(trigger_id):
     """Get messages for a specific trigger"""
-    conn = get_db_connection()
-    messages = conn.execute('''
-        SELECT * FROM messages 
-        WHERE trigger_id = ? 
-        ORDER BY received_at DESC
-    ''', (trigger_id,)).fetchall()
-    conn.close()
-    
-    # Convert to list of dictionaries and format contact names
-    formatted_messages = []
-    for message in messages:
-        msg_dict = dict(message)
-        # Provide both contact name and display name
-        if msg_dict.get('contact_name'):
-            msg_dict['contact_name_only'] = msg_dict['contact_name']
-            msg_dict['display_name'] = f"{msg_dict['contact_name']} ({msg_dict['sender_number']})"
-        else:
-            msg_dict['contact_name_only'] = None
-            msg_dict['display_name'] = msg_dict['sender_number']
-        formatted_messages.append(msg_dict)
+    conn = get_db_connection(readonly=True)
+    messages = conn.execute(SQL_GET_TRIGGER_MESSAGES, (trigger_id,)).fetchall()
     
     return jsonify({
         'success': True,
-        'data': formatted_messages
+        'data': messages
     })
 
 @app.route('/api/triggers/<int:trigger_id>/send', methods=['POST'])
 def send_message(trigger_id):
     """Send a message via WhatsApp"""
     conn = get_db_connection()
-    trigger = conn.execute('SELECT * FROM triggers WHERE id = ?', (trigger_id,)).fetchone()
+    trigger = conn.execute(SQL_GET_TRIGGER_SENDER, (trigger_id,)).fetchone()
     
     if not trigger:
-        conn.close()
         return jsonify({'success': False, 'error': 'Trigger not found'}), 404
     
     if trigger['status'] != 'active':
-        conn.close()
         return jsonify({'success': False, 'error': 'Trigger is not active'}), 400
     
     data = request.get_json()
@@ -591,16 +1083,11 @@ def send_message(trigger_id):
     message_text = data.get('message')
     
     if not to_number or not message_text:
-        conn.close()
         return jsonify({'success': False, 'error': 'Missing to_number or message'}), 400
     
     try:
         # Send message via Meta WhatsApp API
-        url = f"https://graph.facebook.com/v18.0/{trigger['phone_id']}/messages"
-        headers = {
-            'Authorization': f"Bearer {trigger['access_token']}",
-            'Content-Type': 'application/json'
-        }
+        url, headers = graph_api_target(trigger['phone_id'], trigger['access_token'])
         
         payload = {
             "messaging_product": "whatsapp",
@@ -611,219 +1098,290 @@ def send_message(trigger_id):
             }
         }
         
-        # Log the complete Meta API request
-        print("=" * 80)
-        print("🚀 META WHATSAPP API REQUEST - COMPLETE LOG")
-        print("=" * 80)
-        print(f"📅 Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"🎯 Trigger ID: {trigger_id}")
-        print(f"📱 Business Name: {trigger['business_name']}")
-        print(f"📞 Phone ID: {trigger['phone_id']}")
-        print(f"🔑 Access Token: {trigger['access_token'][:20]}...{trigger['access_token'][-10:]}")
-        print()
-        print("🌐 API ENDPOINT:")
-        print(f"   URL: {url}")
-        print(f"   Method: POST")
-        print()
-        print("📋 REQUEST HEADERS:")
-        for key, value in headers.items():
-            if key == 'Authorization':
-                print(f"   {key}: {value[:20]}...{value[-10:]}")
-            else:
-                print(f"   {key}: {value}")
-        print()
-        print("📦 REQUEST PAYLOAD:")
-        print(f"   {json.dumps(payload, indent=2)}")
-        print()
-        print("📤 SENDING REQUEST TO META...")
+        # With ?async=1, record the message as pending and send in the background.
+        # The client gets 202 right away; the send worker flips the row to
+        # 'sent' (storing Meta's message id) or 'failed' once Meta answers.
+        if request.args.get('async') == '1':
+            record_id = conn.execute(SQL_INSERT_MESSAGE, (trigger_id, f"sent_to_{to_number}", message_text, 'pending', '', None)).lastrowid
+            enqueue_send(trigger['phone_id'], url, headers, payload, 'message', to_number, record_id)
+            return jsonify({
+                'success': True,
+                'message': 'Message queued for sending',
+                'record_id': record_id
+            }), 202
         
-        response = requests.post(url, headers=headers, json=payload)
+        logger.info("📤 Sending message to %s via trigger %s", to_number, trigger_id)
         
-        print("📥 META API RESPONSE:")
-        print(f"   Status Code: {response.status_code}")
-        print(f"   Response Headers: {dict(response.headers)}")
-        print(f"   Response Body: {response.text}")
-        print("=" * 80)
+        # Full request/response dumps only when DEBUG is enabled, so production
+        # never pays for the indented JSON or header formatting
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("🚀 Meta API request: POST %s (%s, phone ID %s)\n%s",
+                         url, trigger['business_name'], trigger['phone_id'], orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode())
+        
+        response = SESSION.post(url, headers=headers, data=orjson.dumps(payload), timeout=GRAPH_API_TIMEOUT)
+        
+        if debug:
+            logger.debug("📥 Meta API response: %s %s\n%s",
+                         response.status_code, dict(response.headers), response.text)
         
         if response.status_code == 200:
-            result = response.json()
-            message_id = result.get('messages', [{}])[0].get('id', 'unknown')
+            result = orjson.loads(response.content)
+            meta_message_id = result.get('messages', [{}])[0].get('id')
             
             # Save sent message to database
-            conn.execute('''
-                INSERT INTO messages (trigger_id, sender_number, message_content, message_type)
-                VALUES (?, ?, ?, ?)
-            ''', (trigger_id, f"sent_to_{to_number}", message_text, 'sent'))
-            
-            conn.commit()
-            conn.close()
+            conn.execute(SQL_INSERT_MESSAGE, (trigger_id, f"sent_to_{to_number}", message_text, 'sent', '', meta_message_id))
             
             return jsonify({
                 'success': True,
                 'message': 'Message sent successfully',
-                'message_id': message_id
+                'message_id': meta_message_id or 'unknown'
             })
         else:
-            error_data = response.json() if response.content else {}
+            error_data = orjson.loads(response.content) if response.content else {}
             error_msg = error_data.get('error', {}).get('message', 'Failed to send message')
-            conn.close()
             return jsonify({
                 'success': False,
                 'error': f'WhatsApp API Error: {error_msg}'
             }), 400
             
     except Exception as e:
-        conn.close()
-        print(f"❌ Error sending message: {e}")
+        logger.exception("❌ Error sending message")
         return jsonify({
             'success': False,
             'error': f'Error sending message: {str(e)}'
         }), 500
 
-def handle_lead_generation(trigger_id, phone_number, contact_name, message_content, conn, button_id=None):
+def handle_lead_generation(trigger, phone_number, contact_name, message_content, conn, button_id=None):
     """Handle lead generation logic"""
+    trigger_id = trigger['id']
+    questions = get_trigger_questions(conn, trigger_id)
+    
+    # Without questions there is no lead flow to run, so skip the database
+    if not questions:
+        logger.debug("📋 No lead questions configured for trigger %s", trigger_id)
+        return
+    
+    # Savepoint keeps this lead's writes atomic inside the caller's transaction
+    conn.execute('SAVEPOINT lead_generation')
     try:
         # Check if lead exists
-        lead = conn.execute('''
-            SELECT * FROM leads 
-            WHERE trigger_id = ? AND phone_number = ?
-        ''', (trigger_id, phone_number)).fetchone()
-        
-        # Get questions for this trigger
-        questions = conn.execute('''
-            SELECT * FROM lead_questions 
-            WHERE trigger_id = ? 
-            ORDER BY order_index ASC
-        ''', (trigger_id,)).fetchall()
-        
-        if not questions:
-            print("📋 No lead questions configured for this trigger")
-            return
+        lead = conn.execute(SQL_GET_LEAD_STATE, (trigger_id, phone_number)).fetchone()
         
         if not lead:
             # Create new lead
-            conn.execute('''
-                INSERT INTO leads (trigger_id, phone_number, contact_name, status, current_question, responses)
-                VALUES (?, ?, ?, 'active', 0, '{}')
-            ''', (trigger_id, phone_number, contact_name))
+            conn.execute(SQL_INSERT_LEAD, (trigger_id, phone_number, contact_name, questions[0]['id']))
             
-            # Get the new lead
-            lead = conn.execute('''
-                SELECT * FROM leads 
-                WHERE trigger_id = ? AND phone_number = ?
-            ''', (trigger_id, phone_number)).fetchone()
-            
-            print(f"🆕 Created new lead for {phone_number}")
+            logger.info("🆕 Created new lead for %s", phone_number)
             
             # Send welcome message with interactive buttons
-            send_welcome_message(trigger_id, phone_number)
+            send_welcome_message(trigger, phone_number)
             return
         
         lead_dict = dict(lead)
-        current_question_index = lead_dict['current_question']
         
         # Handle button responses
         if button_id:
             if button_id == "start_lead_generation":
                 # Start the lead generation process
-                if questions:
-                    # Update lead to start from question 0
+                first_question = questions[0] if questions else None
+                if first_question:
+                    # Update lead to start from the first question
                     conn.execute('''
                         UPDATE leads 
-                        SET current_question = 0, status = 'active'
-                        WHERE trigger_id = ? AND phone_number = ?
-                    ''', (trigger_id, phone_number))
+                        SET current_question = 0, current_question_id = ?, status = 'active'
+                        WHERE id = ?
+                    ''', (first_question['id'], lead_dict['id']))
                     
-                    first_question = questions[0]
-                    send_lead_question(trigger_id, phone_number, first_question)
+                    send_lead_question(trigger, phone_number, first_question)
                 else:
                     # Send message that no questions are configured
-                    send_simple_message(trigger_id, phone_number, "Sorry, no questions are configured yet. Please contact support.")
+                    send_simple_message(trigger, phone_number, "Sorry, no questions are configured yet. Please contact support.")
                 return
             elif button_id == "view_services":
-                send_simple_message(trigger_id, phone_number, "Here are our services... (This can be customized per business)")
+                send_simple_message(trigger, phone_number, "Here are our services... (This can be customized per business)")
                 return
             elif button_id == "contact_support":
-                send_simple_message(trigger_id, phone_number, "Our support team will get back to you shortly. Thank you for contacting us!")
+                send_simple_message(trigger, phone_number, "Our support team will get back to you shortly. Thank you for contacting us!")
                 return
         
         # Check if we have more questions to ask
-        if current_question_index < len(questions):
-            current_question = questions[current_question_index]
-            
+        current_question, next_question = find_question(questions, lead_dict['current_question_id'])
+        
+        if current_question:
             # Save the response
-            responses = json.loads(lead_dict['responses'])
+            responses = orjson.loads(lead_dict['responses'])
             responses[f"q{current_question['id']}"] = message_content
             
             # Move to next question
-            next_question_index = current_question_index + 1
-            if next_question_index >= len(questions):
+            answered_count = lead_dict['current_question'] + 1
+            if next_question is None:
                 # All questions answered
                 status = 'completed'
-                print(f"✅ Lead completed for {phone_number}")
+                logger.info("✅ Lead completed for %s", phone_number)
                 
                 # Send completion confirmation message
-                send_completion_message(trigger_id, phone_number)
+                send_completion_message(trigger, phone_number)
             else:
                 status = 'active'
-                print(f"📝 Lead progress: {next_question_index}/{len(questions)} questions answered")
+                logger.debug("📝 Lead progress: %s questions answered", answered_count)
             
             # Update lead
-            conn.execute('''
-                UPDATE leads 
-                SET responses = ?, current_question = ?, status = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (json.dumps(responses), next_question_index, status, lead_dict['id']))
+            conn.execute(SQL_UPDATE_LEAD_PROGRESS, (
+                orjson.dumps(responses).decode(), answered_count,
+                next_question['id'] if next_question else None, status, lead_dict['id']
+            ))
             
             # Send next question if not completed
-            if status == 'active' and next_question_index < len(questions):
-                next_question = questions[next_question_index]
-                send_lead_question(trigger_id, phone_number, next_question)
+            if next_question:
+                send_lead_question(trigger, phone_number, next_question)
         else:
-            print(f"📋 All questions already answered for {phone_number}")
+            logger.debug("📋 All questions already answered for %s", phone_number)
             
     except Exception as e:
-        print(f"❌ Error in lead generation: {str(e)}")
+        conn.execute('ROLLBACK TO lead_generation')
+        logger.error("❌ Error in lead generation: %s", e)
+    finally:
+        conn.execute('RELEASE lead_generation')
 
-def send_completion_message(trigger_id, phone_number):
-    """Send completion confirmation message after all questions are answered"""
+# Token buckets per phone_id: phone_id -> (tokens, last refill time)
+_send_buckets = {}
+# Sends waiting on their number's rate limit: phone_id -> deque of queued sends,
+# and a heap of (due time, phone_id) for every number with a backlog
+_send_backlog = {}
+_send_schedule = []
+_sends_outstanding = 0
+_send_cond = threading.Condition()
+
+def take_send_token(phone_id, now):
+    """Take a token from the phone_id's bucket; return 0, or the seconds until one is available
+
+    Caller holds _send_cond.
+    """
+    tokens, updated = _send_buckets.get(phone_id, (SEND_RATE_PER_NUMBER, now))
+    tokens = min(SEND_RATE_PER_NUMBER, tokens + (now - updated) * SEND_RATE_PER_NUMBER)
+    if tokens >= 1:
+        _send_buckets[phone_id] = (tokens - 1, now)
+        return 0
+    _send_buckets[phone_id] = (tokens, now)
+    return (1 - tokens) / SEND_RATE_PER_NUMBER
+
+def enqueue_send(phone_id, url, headers, payload, description, phone_number, record_id=None):
+    """Queue a Graph API send for the background workers
+
+    record_id is an optional 'pending' messages row to mark 'sent' (with Meta's
+    message id) or 'failed'.
+    """
+    global _sends_outstanding
+    with _send_cond:
+        accepted = _sends_outstanding < SEND_QUEUE_LIMIT
+        if accepted:
+            _sends_outstanding += 1
+            backlog = _send_backlog.setdefault(phone_id, deque())
+            backlog.append((url, headers, payload, description, phone_number, record_id))
+            if len(backlog) == 1:
+                heapq.heappush(_send_schedule, (time.monotonic(), phone_id))
+                _send_cond.notify()
+    
+    if not accepted:
+        logger.error("❌ Send queue full, dropping %s to %s", description, phone_number)
+        if record_id is not None:
+            get_db_connection().execute(SQL_UPDATE_MESSAGE_STATUS, ('failed', None, record_id))
+
+def send_pacer():
+    """Background thread: release each number's sends to OUT_QUEUE, in order, as its token bucket allows"""
+    while True:
+        with _send_cond:
+            while not _send_schedule:
+                _send_cond.wait()
+            
+            now = time.monotonic()
+            due, phone_id = _send_schedule[0]
+            if due > now:
+                # A newly queued number may be due sooner, so wake on notify too
+                _send_cond.wait(due - now)
+                continue
+            
+            heapq.heappop(_send_schedule)
+            wait = take_send_token(phone_id, now)
+            if wait:
+                heapq.heappush(_send_schedule, (now + wait, phone_id))
+                continue
+            
+            backlog = _send_backlog[phone_id]
+            send = backlog.popleft()
+            if backlog:
+                heapq.heappush(_send_schedule, (now, phone_id))
+            else:
+                del _send_backlog[phone_id]
+        OUT_QUEUE.put(send)
+
+def send_worker():
+    """Post sends released by the pacer to the Graph API"""
+    global _sends_outstanding
+    while True:
+        url, headers, payload, description, phone_number, record_id = OUT_QUEUE.get()
+        try:
+            meta_message_id = post_to_meta(url, headers, payload, description, phone_number)
+            if record_id is not None:
+                status = 'sent' if meta_message_id else 'failed'
+                get_db_connection().execute(SQL_UPDATE_MESSAGE_STATUS, (status, meta_message_id, record_id))
+        except Exception:
+            logger.exception("❌ Error updating status of %s to %s", description, phone_number)
+        finally:
+            with _send_cond:
+                _sends_outstanding -= 1
+
+threading.Thread(target=send_pacer, name='meta-send-pacer', daemon=True).start()
+for _ in range(SEND_CONCURRENCY):
+    threading.Thread(target=send_worker, name='meta-send', daemon=True).start()
+
+@lru_cache(maxsize=2048)
+def graph_api_target(phone_id, access_token):
+    """Messages URL and auth header for a WhatsApp number, built once per token"""
+    url = f"https://graph.facebook.com/v18.0/{phone_id}/messages"
+    headers = {'Authorization': f'Bearer {access_token}'}
+    return url, headers
+
+def post_to_meta(url, headers, payload, description, phone_number):
+    """POST a message to the Graph API, log the outcome and return Meta's message id (None on failure)"""
     try:
-        # Get trigger details
-        conn = get_db_connection()
-        trigger = conn.execute('''
-            SELECT * FROM triggers WHERE id = ?
-        ''', (trigger_id,)).fetchone()
-        conn.close()
-        
-        if not trigger:
-            print(f"❌ Trigger {trigger_id} not found")
-            return
-        
-        trigger_dict = dict(trigger)
+        response = SESSION.post(url, headers=headers, data=orjson.dumps(payload), timeout=GRAPH_API_TIMEOUT)
         
+        if response.status_code == 200:
+            logger.info("✅ %s sent successfully to %s", description.capitalize(), phone_number)
+            return orjson.loads(response.content).get('messages', [{}])[0].get('id')
+        logger.error("❌ Failed to send %s: %s - %s", description, response.status_code, response.text)
+            
+    except Exception as e:
+        logger.error("❌ Error sending %s: %s", description, e)
+    return None
+
+# The lead-flow send helpers below run on the lead worker inside its
+# transaction; they only queue the Graph API call for the send pool, so the
+# SQLite write lock is never held while waiting on Meta
+def send_completion_message(trigger, phone_number):
+    """Send completion confirmation message after all questions are answered"""
+    try:
         # Create completion message
-        if trigger_dict.get('completion_message') and trigger_dict['completion_message'].strip():
+        if trigger['completion_message'] and trigger['completion_message'].strip():
             # Use custom completion message
-            completion_text = trigger_dict['completion_message']
+            completion_text = trigger['completion_message']
         else:
             # Use default completion message
             completion_text = f"""🎉 Thank you for providing all the information!
 
-Our team at {trigger_dict['business_name']} has received your details and will contact you within 24 hours to discuss your requirements.
+Our team at {trigger['business_name']} has received your details and will contact you within 24 hours to discuss your requirements.
 
 We appreciate your interest and look forward to helping you! 
 
 If you have any urgent questions, feel free to message us anytime.
 
 Best regards,
-{trigger_dict['business_name']} Team"""
+{trigger['business_name']} Team"""
         
         # Send completion message
-        url = f"https://graph.facebook.com/v18.0/{trigger_dict['phone_id']}/messages"
-        headers = {
-            'Authorization': f'Bearer {trigger_dict["access_token"]}',
-            'Content-Type': 'application/json'
-        }
+        url, headers = graph_api_target(trigger['phone_id'], trigger['access_token'])
         
         payload = {
             "messaging_product": "whatsapp",
@@ -834,40 +1392,18 @@ Best regards,
             }
         }
         
-        print(f"📤 Sending completion message to {phone_number}")
+        logger.debug("📤 Sending completion message to %s", phone_number)
         
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            print(f"✅ Completion message sent successfully to {phone_number}")
-        else:
-            print(f"❌ Failed to send completion message: {response.status_code} - {response.text}")
+        enqueue_send(trigger['phone_id'], url, headers, payload, 'completion message', phone_number)
             
     except Exception as e:
-        print(f"❌ Error sending completion message: {str(e)}")
+        logger.error("❌ Error sending completion message: %s", e)
 
-def send_simple_message(trigger_id, phone_number, message_text):
+def send_simple_message(trigger, phone_number, message_text):
     """Send a simple text message"""
     try:
-        # Get trigger details
-        conn = get_db_connection()
-        trigger = conn.execute('''
-            SELECT * FROM triggers WHERE id = ?
-        ''', (trigger_id,)).fetchone()
-        conn.close()
-        
-        if not trigger:
-            print(f"❌ Trigger {trigger_id} not found")
-            return
-        
-        trigger_dict = dict(trigger)
-        
         # Send simple text message
-        url = f"https://graph.facebook.com/v18.0/{trigger_dict['phone_id']}/messages"
-        headers = {
-            'Authorization': f'Bearer {trigger_dict["access_token"]}',
-            'Content-Type': 'application/json'
-        }
+        url, headers = graph_api_target(trigger['phone_id'], trigger['access_token'])
         
         payload = {
             "messaging_product": "whatsapp",
@@ -878,40 +1414,46 @@ def send_simple_message(trigger_id, phone_number, message_text):
             }
         }
         
-        print(f"📤 Sending simple message to {phone_number}: {message_text}")
+        logger.debug("📤 Sending simple message to %s: %s", phone_number, message_text)
         
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            print(f"✅ Simple message sent successfully to {phone_number}")
-        else:
-            print(f"❌ Failed to send simple message: {response.status_code} - {response.text}")
+        enqueue_send(trigger['phone_id'], url, headers, payload, 'simple message', phone_number)
             
     except Exception as e:
-        print(f"❌ Error sending simple message: {str(e)}")
+        logger.error("❌ Error sending simple message: %s", e)
+
+# The welcome buttons are the same for every trigger, so all welcome
+# payloads share this one (read-only) action block
+WELCOME_ACTION = {
+    "buttons": [
+        {
+            "type": "reply",
+            "reply": {
+                "id": "start_lead_generation",
+                "title": "📋 Get Started"
+            }
+        },
+        {
+            "type": "reply",
+            "reply": {
+                "id": "view_services",
+                "title": "📌 Our Services"
+            }
+        },
+        {
+            "type": "reply",
+            "reply": {
+                "id": "contact_support",
+                "title": "📞 Talk to Us"
+            }
+        }
+    ]
+}
 
-def send_welcome_message(trigger_id, phone_number):
+def send_welcome_message(trigger, phone_number):
     """Send welcome message with interactive buttons"""
     try:
-        # Get trigger details
-        conn = get_db_connection()
-        trigger = conn.execute('''
-            SELECT * FROM triggers WHERE id = ?
-        ''', (trigger_id,)).fetchone()
-        conn.close()
-        
-        if not trigger:
-            print(f"❌ Trigger {trigger_id} not found")
-            return
-        
-        trigger_dict = dict(trigger)
-        
         # Send interactive welcome message
-        url = f"https://graph.facebook.com/v18.0/{trigger_dict['phone_id']}/messages"
-        headers = {
-            'Authorization': f'Bearer {trigger_dict["access_token"]}',
-            'Content-Type': 'application/json'
-        }
+        url, headers = graph_api_target(trigger['phone_id'], trigger['access_token'])
         
         payload = {
             "messaging_product": "whatsapp",
@@ -920,74 +1462,28 @@ def send_welcome_message(trigger_id, phone_number):
             "interactive": {
                 "type": "button",
                 "body": {
-                    "text": f"Hi 👋, thanks for reaching out to {trigger_dict['business_name']}! How can we help you today?"
+                    "text": f"Hi 👋, thanks for reaching out to {trigger['business_name']}! How can we help you today?"
                 },
-                "action": {
-                    "buttons": [
-                        {
-                            "type": "reply",
-                            "reply": {
-                                "id": "start_lead_generation",
-                                "title": "📋 Get Started"
-                            }
-                        },
-                        {
-                            "type": "reply",
-                            "reply": {
-                                "id": "view_services",
-                                "title": "📌 Our Services"
-                            }
-                        },
-                        {
-                            "type": "reply",
-                            "reply": {
-                                "id": "contact_support",
-                                "title": "📞 Talk to Us"
-                            }
-                        }
-                    ]
-                }
+                "action": WELCOME_ACTION
             }
         }
         
-        print(f"📤 Sending welcome message to {phone_number}")
+        logger.debug("📤 Sending welcome message to %s", phone_number)
         
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            print(f"✅ Welcome message sent successfully to {phone_number}")
-        else:
-            print(f"❌ Failed to send welcome message: {response.status_code} - {response.text}")
+        enqueue_send(trigger['phone_id'], url, headers, payload, 'welcome message', phone_number)
             
     except Exception as e:
-        print(f"❌ Error sending welcome message: {str(e)}")
+        logger.error("❌ Error sending welcome message: %s", e)
 
-def send_lead_question(trigger_id, phone_number, question):
+def send_lead_question(trigger, phone_number, question):
     """Send a lead question via WhatsApp"""
     try:
-        # Get trigger details
-        conn = get_db_connection()
-        trigger = conn.execute('''
-            SELECT * FROM triggers WHERE id = ?
-        ''', (trigger_id,)).fetchone()
-        conn.close()
-        
-        if not trigger:
-            print(f"❌ Trigger {trigger_id} not found")
-            return
-        
-        trigger_dict = dict(trigger)
-        
         # Send message via Meta API
-        url = f"https://graph.facebook.com/v18.0/{trigger_dict['phone_id']}/messages"
-        headers = {
-            'Authorization': f'Bearer {trigger_dict["access_token"]}',
-            'Content-Type': 'application/json'
-        }
+        url, headers = graph_api_target(trigger['phone_id'], trigger['access_token'])
         
         # Prepare message based on question type
         if question['question_type'] == 'multiple_choice':
-            options = json.loads(question['options'])
+            options = orjson.loads(question['options'])
             
             # Create interactive button message
             buttons = []
@@ -1025,17 +1521,12 @@ def send_lead_question(trigger_id, phone_number, question):
                 }
             }
         
-        print(f"📤 Sending lead question to {phone_number}: {question['question_text']}")
+        logger.debug("📤 Sending lead question to %s: %s", phone_number, question['question_text'])
         
-        response = requests.post(url, headers=headers, json=payload)
-        
-        if response.status_code == 200:
-            print(f"✅ Lead question sent successfully to {phone_number}")
-        else:
-            print(f"❌ Failed to send lead question: {response.status_code} - {response.text}")
+        enqueue_send(trigger['phone_id'], url, headers, payload, 'lead question', phone_number)
             
     except Exception as e:
-        print(f"❌ Error sending lead question: {str(e)}")
+        logger.error("❌ Error sending lead question: %s", e)
 
 @app.route('/whatsapp/<node_id>', methods=['GET'])
 def verify_webhook(node_id):
@@ -1044,9 +1535,7 @@ def verify_webhook(node_id):
     token = request.args.get('hub.verify_token')
     challenge = request.args.get('hub.challenge')
     
-    conn = get_db_connection()
-    trigger = conn.execute('SELECT * FROM triggers WHERE node_id = ?', (node_id,)).fetchone()
-    conn.close()
+    trigger = get_trigger_by_node(node_id)
     
     if not trigger:
         return 'Trigger not found', 404
@@ -1056,130 +1545,172 @@ def verify_webhook(node_id):
     else:
         return 'Verification failed', 403
 
+def process_lead_events(trigger, events):
+    """Save one webhook's messages and apply their lead events in a single transaction"""
+    conn = get_db_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for row, (sender_number, contact_name, content, button_id) in events:
+            # INSERT OR IGNORE skips a message whose Meta id is already stored;
+            # that is a webhook redelivery, which must not count as a new answer
+            if conn.execute(SQL_INSERT_MESSAGE, row).rowcount == 0:
+                logger.info("🔁 Skipping redelivered message %s from %s", row[5], sender_number)
+                continue
+            handle_lead_generation(trigger, sender_number, contact_name, content, conn, button_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def lead_worker():
+    """Background thread: apply queued webhook lead events in arrival order"""
+    while True:
+        trigger, events = LEAD_QUEUE.get()
+        try:
+            process_lead_events(trigger, events)
+        except Exception:
+            logger.exception("❌ Error processing lead events for trigger %s", trigger['id'])
+
+threading.Thread(target=lead_worker, name='lead-worker', daemon=True).start()
+
+# Message parsers return (stored content, message type, lead answer, button id)
+def parse_text_message(message):
+    """Parse a plain text message"""
+    body = message['text']['body']
+    return body, 'text', body, None
+
+def parse_interactive_message(message):
+    """Parse an interactive message, picking out button replies"""
+    interactive = message['interactive']
+    if interactive['type'] == 'button_reply':
+        reply = interactive['button_reply']
+        logger.debug("🔘 Button clicked: %s (ID: %s)", reply['title'], reply['id'])
+        return f"[Button Clicked] {reply['title']}", 'interactive', reply['title'], reply['id']
+    return '[Interactive Message]', 'interactive', '[Interactive Message]', None
+
+def parse_media_message(message):
+    """Parse any other message type (images, audio, documents, ...)"""
+    return '[Media Message]', 'media', '[Media Message]', None
+
+MESSAGE_PARSERS = {
+    'text': parse_text_message,
+    'interactive': parse_interactive_message,
+}
+
 @app.route('/whatsapp/<node_id>', methods=['POST'])
 def receive_webhook(node_id):
     """Receive WhatsApp messages"""
-    print(f"🔔 Webhook received for node_id: {node_id}")
+    logger.debug("🔔 Webhook received for node_id: %s", node_id)
     
-    conn = get_db_connection()
-    trigger = conn.execute('SELECT * FROM triggers WHERE node_id = ?', (node_id,)).fetchone()
+    trigger = get_trigger_by_node(node_id)
     
     if not trigger:
-        print(f"❌ Trigger not found for node_id: {node_id}")
-        conn.close()
+        logger.warning("❌ Trigger not found for node_id: %s", node_id)
         return 'Trigger not found', 404
     
-    print(f"✅ Trigger found: {trigger['business_name']} (ID: {trigger['id']}, Status: {trigger['status']})")
+    logger.debug("✅ Trigger found: %s (ID: %s, Status: %s)", trigger['business_name'], trigger['id'], trigger['status'])
     
     if trigger['status'] != 'active':
-        print(f"⚠️ Trigger is inactive, ignoring message")
-        conn.close()
+        logger.info("⚠️ Trigger %s is inactive, ignoring message", trigger['id'])
         return 'Trigger is inactive', 200
     
+    conn = get_db_connection()
     try:
-        # Log the complete incoming webhook request from Meta
-        print("=" * 80)
-        print("📨 META WEBHOOK REQUEST - COMPLETE LOG")
-        print("=" * 80)
-        print(f"📅 Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print(f"🎯 Node ID: {node_id}")
-        print(f"📱 Business Name: {trigger['business_name']}")
-        print()
-        print("🌐 INCOMING REQUEST:")
-        print(f"   Method: {request.method}")
-        print(f"   URL: {request.url}")
-        print(f"   Remote Address: {request.remote_addr}")
-        print(f"   User Agent: {request.headers.get('User-Agent', 'Unknown')}")
-        print()
-        print("📋 REQUEST HEADERS:")
-        for key, value in request.headers:
-            print(f"   {key}: {value}")
-        print()
-        
-        data = request.get_json()
-        print("📦 REQUEST BODY (JSON):")
-        print(f"   {json.dumps(data, indent=2)}")
-        print("=" * 80)
+        # Read the body once; signature check and parsing share this copy, so
+        # Flask doesn't need to keep its own cached one
+        raw = request.get_data(cache=False)
+        
+        if not verify_webhook_signature(raw, request.headers.get('X-Hub-Signature-256', '')):
+            logger.warning("❌ Invalid webhook signature for node_id: %s", node_id)
+            return 'Invalid signature', 403
+        
+        # Status receipts (sent/delivered/read) are most of Meta's webhook traffic
+        # and carry no "messages" key, so acknowledge them without parsing
+        if b'"messages"' not in raw:
+            logger.debug("📭 Webhook for node %s has no messages: %s", node_id, raw)
+            return 'OK', 200
+        
+        data = orjson.loads(raw)
+        
+        # Log the complete incoming webhook request from Meta, but only build
+        # the header list and indented body when DEBUG is actually enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            headers = '\n'.join(f"   {key}: {value}" for key, value in request.headers)
+            logger.debug(
+                "📨 Meta webhook request for %s (node %s)\n"
+                "🌐 %s %s from %s\n"
+                "📋 Headers:\n%s\n"
+                "📦 Body:\n%s",
+                trigger['business_name'], node_id,
+                request.method, request.url, request.remote_addr,
+                headers,
+                orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()
+            )
         
-        # Handle test calls from Meta (but still process messages if they exist)
-        if 'object' in data and data['object'] == 'whatsapp_business_account':
-            print("🧪 Meta test call detected, but checking for messages...")
-            # Don't return early, continue to process messages if they exist
+        message_rows = []
+        lead_events = []
         
         # Process incoming messages
         if 'entry' in data:
             for entry in data['entry']:
                 if 'changes' in entry:
                     for change in entry['changes']:
-                        if 'value' in change and 'messages' in change['value']:
-                            print(f"💬 Processing {len(change['value']['messages'])} messages")
+                        value = change.get('value', {})
+                        messages = value.get('messages')
+                        if messages:
+                            logger.info("💬 Processing %d messages for %s", len(messages), trigger['business_name'])
                             
-                            # Extract contact names from the contacts section
-                            contact_names = {}
-                            if 'contacts' in change['value']:
-                                for contact in change['value']['contacts']:
-                                    wa_id = contact.get('wa_id')
-                                    profile_name = contact.get('profile', {}).get('name', '')
-                                    if wa_id and profile_name:
-                                        contact_names[wa_id] = profile_name
-                                        print(f"👤 Contact name found: {wa_id} -> {profile_name}")
+                            # Map wa_id -> profile name in one pass over the contacts section
+                            contact_names = {
+                                contact['wa_id']: contact['profile']['name']
+                                for contact in value.get('contacts', ())
+                                if contact.get('wa_id') and contact.get('profile', {}).get('name')
+                            }
                             
-        for message in change['value']['messages']:
-            sender_number = message['from']
-            
-            # Handle different message types
-            if 'text' in message:
-                message_content = message['text']['body']
-                message_type = 'text'
-            elif 'interactive' in message:
-                # Handle interactive button responses
-                interactive = message['interactive']
-                if interactive['type'] == 'button_reply':
-                    button_id = interactive['button_reply']['id']
-                    button_title = interactive['button_reply']['title']
-                    message_content = f"[Button Clicked] {button_title}"
-                    message_type = 'interactive'
-                    print(f"🔘 Button clicked: {button_title} (ID: {button_id})")
-                else:
-                    message_content = '[Interactive Message]'
-                    message_type = 'interactive'
-            else:
-                message_content = '[Media Message]'
-                message_type = 'media'
-            
-            # Get contact name if available
-            contact_name = contact_names.get(sender_number, '')
-            display_name = f"{contact_name} ({sender_number})" if contact_name else sender_number
-            
-            print(f"📝 Saving message from {display_name}: {message_content}")
-            
-            # Save message to database with contact name
-            conn.execute('''
-                INSERT INTO messages (trigger_id, sender_number, message_content, message_type, contact_name)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (trigger['id'], sender_number, message_content, message_type, contact_name))
-            
-            # Handle lead generation with button response processing
-            if 'interactive' in message and interactive['type'] == 'button_reply':
-                button_id = interactive['button_reply']['id']
-                button_title = interactive['button_reply']['title']
-                handle_lead_generation(trigger['id'], sender_number, contact_name, button_title, conn, button_id)
-            else:
-                handle_lead_generation(trigger['id'], sender_number, contact_name, message_content, conn)
+                            for message in messages:
+                                sender_number = message['from']
+                                
+                                # Dispatch on the message's payload key; anything else is media
+                                parser = next((MESSAGE_PARSERS[key] for key in MESSAGE_PARSERS if key in message), parse_media_message)
+                                message_content, message_type, lead_content, button_id = parser(message)
+                                
+                                contact_name = contact_names.get(sender_number, '')
+                                message_rows.append((trigger['id'], sender_number, message_content, message_type, contact_name, message.get('id')))
+                                
+                                # Queue lead generation; button replies pass their title and id
+                                lead_events.append((sender_number, contact_name, lead_content, button_id))
+        
+        if not message_rows:
+            return 'OK', 200
+        
+        # Without questions there is no lead flow, so the messages are only
+        # saved, by the background flusher in batches
+        if not get_trigger_questions(conn, trigger['id']):
+            for row in message_rows:
+                try:
+                    MESSAGE_BUFFER.put_nowait(row)
+                except queue.Full:
+                    logger.error("❌ Message buffer full, dropping message from %s for trigger %s", row[1], row[0])
+            logger.debug("📋 No lead updates for trigger %s", trigger['id'])
+            return 'OK', 200
+        
+        # Otherwise the lead worker saves each message together with its lead
+        # update, so Meta gets its 200 without waiting on the SQLite write lock
+        # and a redelivered message is recognised before it is answered twice
+        try:
+            LEAD_QUEUE.put_nowait((trigger, list(zip(message_rows, lead_events))))
+        except queue.Full:
+            logger.error("❌ Lead queue full, dropping %d messages for trigger %s", len(message_rows), trigger['id'])
         
-        conn.commit()
-        conn.close()
-        print("✅ Webhook processed successfully")
+        logger.debug("✅ Webhook processed successfully")
         return 'OK', 200
         
-    except Exception as e:
-        conn.close()
-        print(f"❌ Error processing webhook: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("❌ Error processing webhook")
         return 'Error', 500
 
 if __name__ == '__main__':
+    configure_logging()
     init_db()
     print("🚀 Starting Simple WhatsApp Trigger Manager...")
     print(f"🔧 Base Callback URL: {os.getenv('BASE_CALLBACK_URL', 'Not set')}")
@@ -1191,6 +1722,9 @@ if __name__ == '__main__':
     print("   ✅ Meta webhook requests (when receiving messages)")
     print("   ✅ Complete request/response details")
     print("   ✅ Headers, payloads, and responses")
+    print(f"   🐛 Meta API and webhook payload dumps need LOG_LEVEL=DEBUG (current: {logging.getLevelName(logger.getEffectiveLevel())})")
     print("   ✅ Timestamps and trigger information")
+    print("   🏭 Production: gunicorn wsgi:app (settings in gunicorn.conf.py)")
     print()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Debug mode (reloader + debugger) follows FLASK_DEBUG instead of always being on
+    app.run(host='0.0.0.0', port=5000)
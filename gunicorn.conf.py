@@ -0,0 +1,14 @@
+"""
+gunicorn settings for the WhatsApp Trigger Manager, picked up by `gunicorn wsgi:app`
+"""
+
+bind = '0.0.0.0:5000'
+
+# Keep a single worker process: the trigger/question caches and the per-number
+# send pacing live in memory, so forked workers would each hold their own copy
+# and miss each other's invalidations. Threads cover the I/O-bound webhook,
+# SQLite and Meta API work (gevent would also need monkey-patching of the
+# background send and flush threads).
+workers = 1
+worker_class = 'gthread'
+threads = 32
@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+"""
+WSGI entry point for running the WhatsApp Trigger Manager under a production server
+
+    gunicorn wsgi:app
+
+Worker settings (a single process with 32 threads) live in gunicorn.conf.py.
+"""
+
+from backend import app, configure_logging, init_db
+
+configure_logging()
+init_db()